@@ -1,2 +1,2 @@
-"""Allow users to access the function directly."""
-from flats.flats import flats
+"""Allow users to access the functions directly."""
+from flats.flats import flats, flats_list, flats_bytes
@@ -3,21 +3,109 @@ Minimal library that enables flattening of nested instances of
 iterable containers.
 """
 from __future__ import annotations
-from typing import Union, Optional, Sequence, Iterable
+from typing import Union, Optional, Sequence, Iterable, Dict
+import types
+import itertools
+import abc
 import collections.abc
 import doctest
 
+# Depth value indicating that there is no limit on the depth of traversal.
+_INF = float('inf')
+
+# Stack depth at which traversal to an infinite depth first checks whether any
+# container contains itself (the depth for the next check doubles after each one).
+_CYCLE_CHECK_DEPTH = 1000
+
+# Built-in container types that can be recognized via a single lookup (avoiding
+# the comparatively expensive ``isinstance`` check against an abstract base class).
+_CONTAINER_TYPES = frozenset({
+    tuple, list, set, frozenset, range, bytes, bytearray, str, types.GeneratorType
+})
+
+# Built-in types whose instances can be concatenated directly when flattening
+# into a :obj:`bytes` instance.
+_BYTES_TYPES = frozenset({bytes, bytearray})
+
+# Value indicating that whether an instance of a type is a container depends on
+# the instance itself (*i.e.*, the type supports indexing but not iteration).
+_INDEXABLE = 'indexable'
+
+# Value indicating that a type is a string type (including subclasses of
+# ``collections.UserString``). A string consisting of a single character contains
+# only itself (or, for ``UserString``, an equal new instance), so it is not treated
+# as a container (this ensures that traversal of strings terminates when the depth
+# is infinite).
+_STRING = 'string'
+
+def _container_type(cls: type) -> Union[bool, str]:
+    """
+    Classify the supplied type according to whether its instances are considered
+    instances of a container type (according to this library).
+    """
+    if issubclass(cls, (str, collections.UserString)):
+        return _STRING
+
+    if issubclass(cls, (collections.abc.Iterable, types.GeneratorType)):
+        return True
+
+    return _INDEXABLE if hasattr(cls, '__getitem__') else False
+
+# Classification of each type encountered since the cache was last cleared:
+# ``True`` for subclasses of the container abstract base classes, ``_STRING`` for
+# string types, ``_INDEXABLE`` for other types that define ``__getitem__``, and
+# ``False`` otherwise. The built-in container types above are included only as an
+# initial warm-up (they are discarded along with every other entry whenever the
+# cache is cleared).
+_container_types_cache: Dict[type, Union[bool, str]] = {
+    cls: _container_type(cls) for cls in _CONTAINER_TYPES
+}
+
+# Number of types beyond which the cache of classifications is cleared (so that
+# types created at runtime are not retained indefinitely). The limit is checked
+# only when a call to a public function begins, so the cache may exceed it while
+# a single call is in progress.
+_CONTAINER_TYPES_CACHE_LIMIT = 1024
+
+# Token identifying the state of the abstract base class caches at the time the
+# cache of classifications was last cleared.
+_container_types_cache_token = abc.get_cache_token() # pylint: disable=invalid-name
+
+def _refresh_container_types_cache() -> None:
+    """
+    Clear the cache of classifications if any type has since been registered as a
+    virtual subclass of an abstract base class (which may change how types are
+    classified) or if the cache has grown beyond its limit. This is invoked once
+    at the beginning of each call to a public function (and not during iteration
+    over any results that are evaluated lazily).
+    """
+    global _container_types_cache_token # pylint: disable=global-statement
+    token = abc.get_cache_token()
+    if (
+        token != _container_types_cache_token or
+        len(_container_types_cache) > _CONTAINER_TYPES_CACHE_LIMIT
+    ):
+        _container_types_cache.clear()
+        _container_types_cache_token = token
+
 def _is_container(instance: Union[Iterable, Sequence]) -> bool:
     """
     Return a boolean value indicating whether the supplied object is considered
     an instance of a container type (according to this library).
     """
-    if isinstance(instance, (
-            tuple, list, set, frozenset,
-            collections.abc.Iterable, collections.abc.Generator
-        )):
-        return True
+    cls = type(instance)
+    is_container_type = _container_types_cache.get(cls)
+    if is_container_type is None:
+        is_container_type = _container_types_cache[cls] = _container_type(cls)
+
+    if is_container_type is _STRING:
+        return len(instance) != 1
+
+    if is_container_type is not _INDEXABLE:
+        return is_container_type
 
+    # Only objects that support indexing (but not iteration) are probed, so
+    # this never consumes an item from an iterator.
     try:
         _ = instance[0]
         return True
@@ -25,6 +113,90 @@ def _is_container(instance: Union[Iterable, Sequence]) -> bool:
     except: # pylint: disable=bare-except
         return False
 
+def _raise_if_cyclic(containers: list) -> None:
+    """
+    Raise an exception if the supplied list of the containers being traversed
+    (from the root to the current position) includes any container more than once.
+    """
+    if len(set(map(id, containers))) < len(containers):
+        raise ValueError(
+            'cannot flatten a container that contains itself to an infinite depth'
+        )
+
+def _validate_depth(depth: Optional[int]) -> int:
+    """
+    Raise an exception if the supplied depth argument is not valid and, otherwise,
+    return the depth as an integer (with ``-1`` representing an infinite depth, so
+    that callers can dispatch on whether the depth is negative).
+    """
+    if isinstance(depth, int): # Most common case is first for efficiency.
+        if depth < 0:
+            raise ValueError('depth must be a non-negative integer or infinity')
+
+        return depth
+
+    if depth == _INF:
+        return -1
+
+    raise TypeError('depth must be an integer or infinity')
+
+def _flats_inf(xss: Iterable, leaf_types: frozenset = frozenset()) -> Iterable:
+    """
+    Generator that flattens the supplied iterable to an infinite depth (see
+    :obj:`flats` for details). Traversal uses an explicit stack of iterators
+    (rather than recursion). Instances of any of the container types in the
+    optional ``leaf_types`` argument are yielded without being traversed.
+    """
+    # The containers being traversed are tracked (in the same order as the stack)
+    # so that a container that contains itself can be detected.
+    stack = [iter(xss)]
+    path = [xss]
+    cycle_check_depth = _CYCLE_CHECK_DEPTH
+    while stack:
+        for xs in stack[-1]:
+            if _is_container(xs) and type(xs) not in leaf_types:
+                path.append(xs)
+                stack.append(iter(xs))
+                if len(stack) > cycle_check_depth:
+                    _raise_if_cyclic(path)
+                    cycle_check_depth *= 2
+
+                break
+
+            yield xs
+
+        else:
+            stack.pop()
+            path.pop()
+
+def _flats_n(
+        xss: Iterable, depth: int, leaf_types: frozenset = frozenset()
+    ) -> Iterable:
+    """
+    Generator that flattens the supplied iterable to a finite depth that is
+    greater than ``1`` (see :obj:`flats` for details). Traversal uses an explicit
+    stack of iterators (rather than recursion), each paired with the number of
+    layers that remain to be flattened within it. Instances of any of the container
+    types in the optional ``leaf_types`` argument are yielded without being traversed.
+    """
+    # Every entry has at least one layer that remains to be flattened, so the contents
+    # of containers at the last layer can be yielded directly (without a new entry).
+    stack = [(iter(xss), depth)]
+    while stack:
+        (xs_iter, depth_remaining) = stack[-1]
+        for xs in xs_iter:
+            if _is_container(xs) and type(xs) not in leaf_types:
+                if depth_remaining == 1:
+                    yield from xs
+                else:
+                    stack.append((iter(xs), depth_remaining - 1))
+                    break
+            else:
+                yield xs
+
+        else:
+            stack.pop()
+
 def flats(xss: Iterable, depth: Optional[int] = 1) -> Iterable:
     """
     Flatten an instance of a container type that is the root of a tree of nested
@@ -64,6 +236,11 @@ def flats(xss: Iterable, depth: Optional[int] = 1) -> Iterable:
     >>> list(flats([bytearray([0, 1, 2]), bytearray([3, 4, 5])]))
     [0, 1, 2, 3, 4, 5]
 
+    Any object that is not an instance of a container type is included as-is.
+
+    >>> list(flats([1, [2, 3], 4]))
+    [1, 2, 3, 4]
+
     The optional ``depth`` argument can be used to limit the depth at which nested
     instances of a container type are not recursively traversed. For example, setting
     ``depth`` to ``1`` is sufficient to flatten any list of lists into a list. Thus,
@@ -92,6 +269,37 @@ def flats(xss: Iterable, depth: Optional[int] = 1) -> Iterable:
     >>> list(flats([[[1, [2]], 3], [4, [[[5]]], 6, 7]], depth=float('inf')))
     [1, 2, 3, 4, 5, 6, 7]
 
+    A string that consists of a single character is not flattened further (as it
+    would otherwise contain only itself). The same is true for instances of
+    :obj:`collections.UserString` (which yield new instances when iterated).
+
+    >>> list(flats(['abc', ['x', ['yz']]], depth=float('inf')))
+    ['a', 'b', 'c', 'x', 'y', 'z']
+    >>> list(flats([collections.UserString('ab')], depth=float('inf')))
+    ['a', 'b']
+
+    Traversal does not rely on recursion, so the depth of the nested structure is
+    not constrained by the interpreter's recursion limit.
+
+    >>> xss = [1]
+    >>> for _ in range(10000):
+    ...     xss = [xss]
+    >>> list(flats(xss, depth=float('inf')))
+    [1]
+
+    An exception is raised if a container that contains itself (directly or
+    indirectly) is encountered when ``depth`` is infinite, as such a structure
+    cannot be flattened completely. Any finite depth is still supported.
+
+    >>> xss = [1, [2]]
+    >>> xss[1].append(xss)
+    >>> list(flats(xss, depth=float('inf')))
+    Traceback (most recent call last):
+      ...
+    ValueError: cannot flatten a container that contains itself to an infinite depth
+    >>> list(flats(xss, depth=2))[:3]
+    [1, 2, 1]
+
     If the value of the ``depth`` argument is not a non-negative integer, an exception
     is raised.
 
@@ -104,7 +312,9 @@ def flats(xss: Iterable, depth: Optional[int] = 1) -> Iterable:
       ...
     ValueError: depth must be a non-negative integer or infinity
 
-    User-defined container types are also supported.
+    User-defined container types are also supported. An instance of a type that
+    supports indexing (but is not an :obj:`~collections.abc.Iterable`) is considered
+    an instance of a container type only if the item at index ``0`` can be retrieved.
 
     >>> class wrap():
     ...     def __init__(self, xs): self.xs = xs
@@ -112,39 +322,184 @@ def flats(xss: Iterable, depth: Optional[int] = 1) -> Iterable:
     ...     def __repr__(self): return 'wrap(' + str(self.xs) + ')'
     >>> wrap(list(flats(wrap([wrap([1, 2]), wrap([3, 4])]))))
     wrap([1, 2, 3, 4])
+    >>> list(flats([wrap([1, 2]), wrap([])]))
+    [1, 2, wrap([])]
+
+    Registration of a type as a virtual subclass of :obj:`~collections.abc.Iterable`
+    is respected by any call made after the registration (even if instances of that
+    type have been flattened before). Results that are evaluated lazily may not
+    reflect a registration made after the call that produced them.
+
+    >>> _ = collections.abc.Iterable.register(wrap)
+    >>> list(flats([wrap([1, 2]), wrap([])]))
+    [1, 2]
+    """
+    depth = _validate_depth(depth)
+    _refresh_container_types_cache()
+
+    if depth < 0:
+        return _flats_inf(xss)
+
+    if depth == 0: # Contents are returned unmodified, so no generator is needed.
+        return iter(xss)
+
+    if depth == 1: # Most common case is handled entirely by built-in iterators.
+        return itertools.chain.from_iterable(
+            xs if type(xs) in _CONTAINER_TYPES or _is_container(xs) else (xs,)
+            for xs in xss
+        )
+
+    return _flats_n(xss, depth)
+
+def flats_list(xss: Iterable, depth: Optional[int] = 1) -> list:
     """
-    # pylint: disable=too-many-branches
+    Flatten an instance of a container type in the same manner as :obj:`flats`,
+    but return the results as a :obj:`list`. For a finite depth, this is more
+    efficient than building a list from the result of :obj:`flats` because no
+    generator is involved and the contents of each innermost container are added
+    using :obj:`list.extend` (for an infinite depth, every object must be examined
+    individually, so the result is built from the same traversal used by :obj:`flats`).
+
+    :param xss: Iterable (usually of container instances) to be flattened.
+    :param depth: Number of layers to flatten (*i.e.*, amount by which the depth of
+        the nested structure should be reduced).
+
+    >>> flats_list([[1, 2, 3], [4, 5, 6, 7]])
+    [1, 2, 3, 4, 5, 6, 7]
+    >>> flats_list([1, (2, 3), iter([4, 5]), 'ab'])
+    [1, 2, 3, 4, 5, 'a', 'b']
+
+    The ``depth`` argument is supported and is interpreted in the same way.
+
+    >>> flats_list([[[1, 2], 3], [4, 5, 6, 7]], depth=0)
+    [[[1, 2], 3], [4, 5, 6, 7]]
+    >>> flats_list([[[1, 2], [3]], [4, [[5, 6]], 7]], depth=2)
+    [1, 2, 3, 4, [5, 6], 7]
+    >>> flats_list([[[1, [2]], 3], [4, [[[5]]], 6, 7]], depth=float('inf'))
+    [1, 2, 3, 4, 5, 6, 7]
+    >>> xss = [1]
+    >>> for _ in range(10000):
+    ...     xss = [xss]
+    >>> flats_list(xss, depth=float('inf'))
+    [1]
+    >>> xss = [1]
+    >>> xss.append(xss)
+    >>> flats_list(xss, depth=float('inf'))
+    Traceback (most recent call last):
+      ...
+    ValueError: cannot flatten a container that contains itself to an infinite depth
+    >>> flats_list([(1, 2, 3), (4, 5, 6, 7)], depth=-1)
+    Traceback (most recent call last):
+      ...
+    ValueError: depth must be a non-negative integer or infinity
+    """
+    depth = _validate_depth(depth)
+    _refresh_container_types_cache()
+
+    if depth <= 0: # Contents are unmodified or every object must be examined.
+        return list(xss if depth == 0 else _flats_inf(xss))
+
+    result = []
+    append = result.append
+    extend = result.extend
+
     if depth == 1: # Most common case is first for efficiency.
         for xs in xss:
-            if _is_container(xs):
-                yield from xs
+            if type(xs) in _CONTAINER_TYPES or _is_container(xs):
+                extend(xs)
             else:
-                yield xs
+                append(xs)
 
-    elif depth == 0: # For consistency, base case is also a generator.
-        yield from xss
+        return result
 
-    else: # General recursive case.
-        for xs in xss:
-            if isinstance(depth, int) and depth >= 1:
-                if _is_container(xs):
-                    yield from flats(xs, depth=depth - 1)
+    # Every entry on the stack has at least one layer that remains to be flattened,
+    # so the contents of containers at the last such layer can be added directly.
+    stack = [(iter(xss), depth)]
+    while stack:
+        (xs_iter, depth_remaining) = stack[-1]
+        for xs in xs_iter:
+            if _is_container(xs):
+                if depth_remaining == 1:
+                    extend(xs)
                 else:
-                    yield xs
+                    stack.append((iter(xs), depth_remaining - 1))
+                    break
+            else:
+                append(xs)
 
-            elif depth == float('inf'):
-                if _is_container(xs):
-                    yield from flats(xs, depth=float('inf'))
-                else:
-                    yield xs
+        else:
+            stack.pop()
+
+    return result
+
+def flats_bytes(xss: Iterable, depth: Optional[int] = 1) -> bytes:
+    """
+    Flatten an instance of a container type in the same manner as :obj:`flats`,
+    but return the results (which must be integers in the range ``0`` through
+    ``255``) as a :obj:`bytes` instance. Any :obj:`bytes` or :obj:`bytearray`
+    instances that are encountered are concatenated directly (without creating
+    an integer object for each individual byte).
+
+    :param xss: Iterable (usually of container instances) to be flattened.
+    :param depth: Number of layers to flatten (*i.e.*, amount by which the depth of
+        the nested structure should be reduced).
+
+    >>> flats_bytes([bytes([0, 1, 2]), bytearray([3, 4, 5])])
+    b'\\x00\\x01\\x02\\x03\\x04\\x05'
+    >>> flats_bytes([bytes([0, 1]), [2, 3], 4, range(5, 7)])
+    b'\\x00\\x01\\x02\\x03\\x04\\x05\\x06'
+
+    The ``depth`` argument is supported and is interpreted in the same way.
+
+    >>> flats_bytes([[b'ab', [99]], [[100, 101]]], depth=2)
+    b'abcde'
+    >>> flats_bytes([[b'ab', [99]], [[[b'd'], 101]]], depth=float('inf'))
+    b'abcde'
+    >>> xss = [b'ab']
+    >>> for _ in range(10000):
+    ...     xss = [xss]
+    >>> flats_bytes(xss, depth=float('inf'))
+    b'ab'
+    >>> xss = [b'ab']
+    >>> xss.append(xss)
+    >>> flats_bytes(xss, depth=float('inf'))
+    Traceback (most recent call last):
+      ...
+    ValueError: cannot flatten a container that contains itself to an infinite depth
+    >>> flats_bytes([0, 1, 2], depth=0)
+    b'\\x00\\x01\\x02'
+
+    An exception is raised if any of the results is not a valid byte value.
 
-            elif isinstance(depth, int) and depth < 0:
-                raise ValueError(
-                    'depth must be a non-negative integer or infinity'
-                )
+    >>> flats_bytes([[1, 2], [256]])
+    Traceback (most recent call last):
+      ...
+    ValueError: bytes must be in range(0, 256)
+    """
+    depth = _validate_depth(depth)
+    _refresh_container_types_cache()
+
+    if depth == 0:
+        return bytes(xss)
+
+    if depth == 1: # Most common case is first for efficiency.
+        return b''.join([
+            xs if type(xs) in _BYTES_TYPES else (
+                bytes(xs) if _is_container(xs) else bytes((xs,))
+            )
+            for xs in xss
+        ])
 
-            elif depth != float('inf') and not isinstance(depth, int):
-                raise TypeError('depth must be an integer or infinity')
+    # Any bytes-like instance found within a layer that is flattened can be included
+    # unmodified, so such instances are not traversed.
+    xss = (
+        _flats_inf(xss, _BYTES_TYPES) if depth < 0 else
+        _flats_n(xss, depth, _BYTES_TYPES)
+    )
+    return b''.join([
+        xs if type(xs) in _BYTES_TYPES else bytes((xs,))
+        for xs in xss
+    ])
 
 if __name__ == '__main__':
     doctest.testmod() # pragma: no cover